@@ -1,13 +1,18 @@
+import io
 import os
-import json
-import base64
+import wave
+import struct
 import asyncio
+import uvloop
+import aiohttp
+import orjson
+import pybase64
 import websockets
-from pydub import AudioSegment
+import numpy as np
 from dotenv import load_dotenv
 import sounddevice as sd
-from scipy.io.wavfile import write
-import requests
+import soundfile as sf
+from scipy.signal import resample_poly
 import concurrent.futures
 
 # Load environment variables
@@ -21,33 +26,41 @@ VAULT_ID = os.getenv('VAULT_ID')
 SKYFLOW_URL = os.getenv('SKYFLOW_URL')  # Base SKYFLOW_URL for the Detect API
 OPENAI_URL_WS = os.getenv('OPENAI_URL_WS') # WebSocket url for OpenAI Realtime API
 
-# Function to record audio from microphone
-def record_audio(duration=10, fs=44100):
+# Function to build a 44-byte RIFF header for 16-bit mono PCM
+def wav_header(num_samples, fs):
+    data_size = num_samples * 2  # 16-bit mono: 2 bytes per sample
+    return struct.pack(
+        '<4sI4s4sIHHIIHH4sI',
+        b'RIFF', 36 + data_size, b'WAVE',
+        b'fmt ', 16, 1, 1, fs, fs * 2, 2, 16,
+        b'data', data_size
+    )
+
+# Function to record audio from microphone, returning WAV bytes in memory
+def record_audio(duration=10, fs=24000):
     print("Recording...")
-    recording = sd.rec(int(duration * fs), samplerate=fs, channels=1)
+    recording = sd.rec(int(duration * fs), samplerate=fs, channels=1, dtype='int16')
     sd.wait()  # Wait until recording is finished
-    write('input.wav', fs, recording)  # Save as WAV file
     print("Recording complete.")
-    return 'input.wav'
-
-# Function to convert WAV to base64
-def convert_wav_to_base64(file_path):
-    with open(file_path, "rb") as wav_file:
-        base64_encoded = base64.b64encode(wav_file.read()).decode('utf-8')
-    return base64_encoded
+    return wav_header(len(recording), fs) + recording.tobytes()
 
 # Function to convert audio to 16-bit PCM, 24kHz, mono, and base64 encode it
 def audio_to_base64(audio_file_path):
-    # Load audio using pydub
-    audio = AudioSegment.from_file(audio_file_path)
-    
-    # Resample to 24kHz mono and convert to 16-bit PCM
-    audio = audio.set_frame_rate(24000).set_channels(1).set_sample_width(2)
-    pcm_audio = audio.raw_data  # Get raw 16-bit PCM data
-    
+    # libsndfile reads the WAV straight into a numpy array, no subprocess
+    data, in_rate = sf.read(audio_file_path, dtype='int16')
+
+    # Downmix and resample in numpy/scipy vector kernels
+    if data.ndim > 1:
+        data = data.mean(axis=1)
+    if in_rate != 24000:
+        # The polyphase filter returns float64 and can overshoot full scale;
+        # clamp before narrowing so peaks saturate instead of wrapping
+        data = np.clip(resample_poly(data, 24000, in_rate), -32768, 32767)
+    pcm_audio = data.astype('<i2').tobytes()
+
     # Encode the PCM audio data to base64
-    pcm_base64 = base64.b64encode(pcm_audio).decode('utf-8')
-    
+    pcm_base64 = pybase64.b64encode_as_string(pcm_audio)
+
     return pcm_base64
 
 # Function to send audio via WebSocket
@@ -66,138 +79,215 @@ async def send_audio(ws, base64_audio):
         }
     }
     
-    # Send the event containing the base64-encoded audio
-    await ws.send(json.dumps(event))
-    await ws.send(json.dumps({"type": "response.create"}))
+    # Send the event containing the base64-encoded audio; orjson writes the
+    # large base64 string via a memcpy fast path, and the Realtime API
+    # expects text frames, so decode the bytes it returns
+    await ws.send(orjson.dumps(event).decode())
+    await ws.send(orjson.dumps({"type": "response.create"}).decode())
+
+# Function to drain WebSocket frames into a queue, keeping the socket read
+# loop free of decode work
+async def pump_frames(ws, queue):
+    try:
+        async for message in ws:
+            await queue.put(message)
+    finally:
+        # Always wake the consumer, even when the connection closes abnormally
+        # and the iteration raises
+        await queue.put(None)
 
 # Function to detect audio using the Detect API
-def detect_audio(file_path):
-    base64_audio = convert_wav_to_base64(file_path)
-    
+async def detect_audio(session, wav_bytes):
     url = f'{SKYFLOW_URL}/v1/detect/file'
     headers = {
-        'Content-Type': 'application/json',
         'x-skyflow-account-id': SKYFLOW_ACCOUNT_ID,
         'Authorization': f'Bearer {SKYFLOW_BEARER_TOKEN}',
     }
-    
-    payload = {
-        "file": base64_audio,
-        "data_format": "wav",
-        "audio": {
-            "output_processed_audio": True,
-            "options": {
-                "bleep_gain": -30,
-                "bleep_start_padding": 0,
-                "bleep_stop_padding": 0
-            }
-        },
-        "accuracy": "high_multilingual",
-        "restrict_entity_types": ["location", "ssn","account_number"],
-        "input_type": "BASE64",
-        "vault_id": VAULT_ID
-    }
-    
-    response = requests.post(url, headers=headers, data=json.dumps(payload))
-    if response.status_code == 200:
-        return response.json()
-    else:
-        print(f"Error: {response.status_code} - {response.text}")
-        return None
+
+    # Upload the raw WAV as multipart/form-data: no base64 encode on our
+    # side, no 33% payload inflation on the wire. Wrapping the buffer in
+    # BytesIO lets aiohttp stream the part in chunks instead of building
+    # a second full copy of the audio for the request body
+    form = aiohttp.FormData()
+    form.add_field('file', io.BytesIO(wav_bytes), filename='input.wav', content_type='audio/wav')
+    form.add_field('data_format', 'wav')
+    form.add_field('audio', orjson.dumps({
+        "output_processed_audio": True,
+        "options": {
+            "bleep_gain": -30,
+            "bleep_start_padding": 0,
+            "bleep_stop_padding": 0
+        }
+    }).decode(), content_type='application/json')
+    form.add_field('accuracy', 'high_multilingual')
+    form.add_field('restrict_entity_types',
+                   orjson.dumps(["location", "ssn", "account_number"]).decode(),
+                   content_type='application/json')
+    form.add_field('input_type', 'FILE')
+    form.add_field('vault_id', VAULT_ID)
+
+    # Compress the upload on the fly; silence runs in the WAV squeeze well
+    # and gzip is cheap next to the network time on the largest request
+    async with session.post(url, headers=headers, data=form, compress='gzip') as response:
+        if response.status == 200:
+            return await response.json(loads=orjson.loads)
+        else:
+            print(f"Error: {response.status} - {await response.text()}")
+            return None
 
 # Function to check processing status
-def check_status(status_id):
+async def check_status(session, status_id):
     url = f'{SKYFLOW_URL}/v1/detect/status/{status_id}?vault_id={VAULT_ID}'
     headers = {'Authorization': f'Bearer {SKYFLOW_BEARER_TOKEN}'}
-    
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        return response.json()
-    else:
-        print(f"Error: {response.status_code} - {response.text}")
-        return None
+
+    async with session.get(url, headers=headers) as response:
+        if response.status == 200:
+            return await response.json(loads=orjson.loads)
+        else:
+            print(f"Error: {response.status} - {await response.text()}")
+            return None
 
 # Main function to handle the entire process
 async def main():
     loop = asyncio.get_event_loop()
-    executor = concurrent.futures.ThreadPoolExecutor()
-    
-    # Step 1: Record audio
-    audio_file_path = await loop.run_in_executor(executor, record_audio, 10, 44100)
-    
-    # Step 2: Call Detect API
-    print("Sending audio for detection...")
-    detect_response = await loop.run_in_executor(executor, detect_audio, audio_file_path)
-    
-    if detect_response and 'status_url' in detect_response:
-        status_id = detect_response['status_url'].split('/')[-1]
-        
-        # Check status until processing is complete
-        while True:
-            status_response = await loop.run_in_executor(executor, check_status, status_id)
-            
-            if status_response and status_response.get("status") == "SUCCESS":
-                for output in status_response["output"]:
-                    if output["processedFileType"] == "redacted_audio":
-                        processed_audio_base64 = output["processedFile"]
-                        processed_audio_path = 'processed_output.wav'
-                        with open(processed_audio_path, "wb") as f:
-                            f.write(base64.b64decode(processed_audio_base64))
-                        print(f"Processed audio saved as {processed_audio_path}")
-                        
-                        # Now, use processed_audio_path as input to OpenAI API
-                        base64_audio = audio_to_base64(processed_audio_path)
-                        
-                        async with websockets.connect(
-                            OPENAI_URL_WS,
-                            extra_headers={
-                                "Authorization": f"Bearer {OPENAI_API_KEY}",
-                                "OpenAI-Beta": "realtime=v1"
-                            }
-                        ) as ws:
-                            print("Connected to OpenAI Realtime API.")
-                            
-                            # Send the encoded audio
-                            await send_audio(ws, base64_audio)
-                            
-                            accumulated_audio = ""
-                            async for message in ws:
-                                parsed_message = json.loads(message)
-                                
-                                # Accumulate the audio deltas in the response
-                                if parsed_message.get("type") == "response.audio.delta":
-                                    delta = parsed_message.get("delta")
-                                    accumulated_audio += delta
-                                
-                                # When the response is complete, save the full base64 audio
-                                elif parsed_message.get("type") == "response.audio.done":
-                                    print("Streaming completed")
-                                    
-                                    pcm_audio = base64.b64decode(accumulated_audio)
-    
-                                    # Reconstruct the AudioSegment from the raw PCM data
-                                    audio = AudioSegment(
-                                        data=pcm_audio,
-                                        sample_width=2,      # 16-bit PCM corresponds to 2 bytes
-                                        frame_rate=24000,    # The sample rate you used for encoding
-                                        channels=1           # Mono audio
-                                    )
-    
-                                    # Export the audio to a file (e.g., WAV format)
-                                    audio.export("output.wav", format="wav")
-                                    
-                                    print("Assistant's reply saved to output.wav")
-                                    break
-                            break  # Break out of the async for loop
-                break  # Break out of the while loop
-            elif status_response.get("status") == "FAILED":
-                print("Audio processing failed.")
-                break
+
+    # Step 1: Record audio; the blocking microphone capture is the only call
+    # that still needs a thread, so use a small bounded pool and release it
+    # Record straight at the Realtime API's 24 kHz target rate
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        wav_bytes = await loop.run_in_executor(executor, record_audio, 10, 24000)
+
+    # One session reuses the TCP/TLS connection for the detect call and every
+    # status poll; the connector keeps connections open between polls and
+    # caches DNS so each poll costs a single round-trip
+    connector = aiohttp.TCPConnector(limit=8, ttl_dns_cache=300, force_close=False)
+    async with aiohttp.ClientSession(
+        connector=connector,
+        json_serialize=lambda obj: orjson.dumps(obj).decode()
+    ) as session:
+        # Step 2: Call Detect API
+        print("Sending audio for detection...")
+        detect_response = await detect_audio(session, wav_bytes)
+
+        if detect_response and 'status_url' in detect_response:
+            status_id = detect_response['status_url'].split('/')[-1]
+
+            # Start the OpenAI handshake now so the TLS/WebSocket setup
+            # overlaps with Detect processing instead of following it;
+            # ensure_future because websockets' connect() is an awaitable
+            # object, not a coroutine, which create_task rejects
+            ws_task = asyncio.ensure_future(websockets.connect(
+                OPENAI_URL_WS,
+                extra_headers={
+                    "Authorization": f"Bearer {OPENAI_API_KEY}",
+                    "OpenAI-Beta": "realtime=v1"
+                }
+            ))
+
+            # Check status until processing is complete, backing off between polls
+            poll_delay = 0.5
+            while True:
+                status_response = await check_status(session, status_id)
+
+                if status_response and status_response.get("status") == "SUCCESS":
+                    for output in status_response["output"]:
+                        if output["processedFileType"] == "redacted_audio":
+                            processed_audio_base64 = output["processedFile"]
+                            processed_audio_path = 'processed_output.wav'
+                            with open(processed_audio_path, "wb") as f:
+                                f.write(pybase64.b64decode(processed_audio_base64, validate=True))
+                            print(f"Processed audio saved as {processed_audio_path}")
+
+                            # Now, use processed_audio_path as input to OpenAI API
+                            base64_audio = audio_to_base64(processed_audio_path)
+
+                            # The handshake ran during the poll loop, so this rarely waits
+                            ws = await ws_task
+                            try:
+                                print("Connected to OpenAI Realtime API.")
+
+                                # Send the encoded audio
+                                await send_audio(ws, base64_audio)
+
+                                # Receive in one task, decode/write in this one, so base64
+                                # decode overlaps network wait instead of stalling reads
+                                queue = asyncio.Queue(maxsize=64)
+                                receiver = asyncio.create_task(pump_frames(ws, queue))
+
+                                pcm_buf = bytearray()
+                                while True:
+                                    message = await queue.get()
+                                    if message is None:
+                                        # Producer finished before response.audio.done: a
+                                        # clean close just ends the stream, an abnormal
+                                        # close re-raises here instead of hanging
+                                        await receiver
+                                        break
+
+                                    # Hot path: nearly every frame is an audio delta, and its
+                                    # base64 payload contains no JSON escapes, so slice the
+                                    # delta out of the raw frame instead of fully parsing it.
+                                    # The deltas are 4-byte-aligned base64, so they decode
+                                    # independently
+                                    if '"response.audio.delta"' in message[:64]:
+                                        # Base64 can never contain a quote, so the first
+                                        # quote ends the value regardless of what keys
+                                        # follow delta in the frame
+                                        delta = message.partition('"delta":"')[2].partition('"')[0]
+                                        pcm_buf += pybase64.b64decode(delta, validate=True)
+                                        continue
+
+                                    parsed_message = orjson.loads(message)
+
+                                    # A delta the prefilter missed (e.g. the type field
+                                    # sitting past the first 64 characters) still lands
+                                    # here, so the fast path is purely an optimization
+                                    if parsed_message.get("type") == "response.audio.delta":
+                                        pcm_buf += pybase64.b64decode(parsed_message["delta"], validate=True)
+
+                                    # When the response is complete, save the accumulated PCM
+                                    elif parsed_message.get("type") == "response.audio.done":
+                                        print("Streaming completed")
+
+                                        # Write the raw PCM straight out as a WAV file
+                                        with wave.open("output.wav", "wb") as w:
+                                            w.setnchannels(1)    # Mono audio
+                                            w.setsampwidth(2)    # 16-bit PCM corresponds to 2 bytes
+                                            w.setframerate(24000)  # The sample rate you used for encoding
+                                            w.writeframes(bytes(pcm_buf))
+
+                                        print("Assistant's reply saved to output.wav")
+                                        break
+
+                                receiver.cancel()
+                            finally:
+                                await ws.close()
+                            break  # Break out of the output loop
+                    break  # Break out of the while loop
+                elif status_response.get("status") == "FAILED":
+                    print("Audio processing failed.")
+                    break
+                else:
+                    print(f"Processing... checking again in {poll_delay:.1f} seconds.")
+                    await asyncio.sleep(poll_delay)
+                    poll_delay = min(poll_delay * 1.5, 4.0)
+
+            # Clean up the pre-opened connection if processing failed before we
+            # used it: cancel a pending handshake, close a completed one, and
+            # retrieve a failed one so its exception is not left unobserved.
+            # On the success path this re-close of the already-used socket is a
+            # no-op
+            if not ws_task.done():
+                ws_task.cancel()
             else:
-                print("Processing... checking again in 2 seconds.")
-                await asyncio.sleep(2)
-    else:
-        print("Error during audio detection.")
+                try:
+                    ws = await ws_task
+                    await ws.close()
+                except Exception as e:
+                    print(f"Discarding failed OpenAI connection: {e}")
+        else:
+            print("Error during audio detection.")
 
 if __name__ == "__main__":
+    uvloop.install()  # libuv event loop: lower per-callback overhead on the delta stream
     asyncio.run(main())